@@ -17,14 +17,25 @@
 """
 
 import argparse
+import concurrent.futures
+import difflib
+import functools
+import json
 import os
+import pathlib
+import random
+import string
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import google.api_core.exceptions
+import google.api_core.retry
 import google.auth
+import google.auth.transport.requests
 from google.auth.credentials import Credentials
 from google.cloud import bigquery
 from google.cloud import bigquery_datatransfer
@@ -35,6 +46,199 @@ from google.cloud.eventarc_v1.types.trigger import CloudRun
 from google.cloud.eventarc_v1.types.trigger import Destination
 from google.cloud.eventarc_v1.types.trigger import EventFilter
 from googleapiclient import discovery
+from googleapiclient import errors
+
+
+# The GCP regions, as listed in https://cloud.google.com/about/locations. The
+# list rarely changes, so it is used instead of asking the Compute API unless
+# --refresh-regions is given.
+GCP_REGIONS = (
+    'africa-south1',
+    'asia-east1',
+    'asia-east2',
+    'asia-northeast1',
+    'asia-northeast2',
+    'asia-northeast3',
+    'asia-south1',
+    'asia-south2',
+    'asia-southeast1',
+    'asia-southeast2',
+    'australia-southeast1',
+    'australia-southeast2',
+    'europe-central2',
+    'europe-north1',
+    'europe-southwest1',
+    'europe-west1',
+    'europe-west2',
+    'europe-west3',
+    'europe-west4',
+    'europe-west6',
+    'europe-west8',
+    'europe-west9',
+    'europe-west10',
+    'europe-west12',
+    'me-central1',
+    'me-central2',
+    'me-west1',
+    'northamerica-northeast1',
+    'northamerica-northeast2',
+    'northamerica-south1',
+    'southamerica-east1',
+    'southamerica-west1',
+    'us-central1',
+    'us-east1',
+    'us-east4',
+    'us-east5',
+    'us-south1',
+    'us-west1',
+    'us-west2',
+    'us-west3',
+    'us-west4',
+)
+
+# The locations the GA export can be in: any region, or the US and EU
+# multi-regions.
+_VALID_REGIONS = frozenset(GCP_REGIONS) | frozenset(['us', 'eu'])
+
+# Where the list of GCP regions is cached between runs, and for how long.
+_REGION_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache',
+                                  'cwv_from_ga4', 'regions.json')
+_REGION_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# How often to check on a scheduled query run, and how long to wait for it. The
+# delay between checks starts short and doubles up to the maximum, so quick
+# runs are noticed quickly without polling long ones too often.
+_TRANSFER_RUN_INITIAL_POLL_SECONDS = 0.5
+_TRANSFER_RUN_MAX_POLL_SECONDS = 5
+_TRANSFER_RUN_TIMEOUT_SECONDS = 5 * 60
+_FINISHED_TRANSFER_STATES = frozenset([
+    bigquery_datatransfer.TransferState.SUCCEEDED,
+    bigquery_datatransfer.TransferState.FAILED,
+    bigquery_datatransfer.TransferState.CANCELLED,
+])
+
+# Transient errors from the gRPC clients are retried with exponential backoff
+# so a brief outage doesn't abort a half finished deployment. Creating
+# resources isn't idempotent, so those calls are only retried when the request
+# was rejected outright.
+_RETRY = google.api_core.retry.Retry(
+    predicate=google.api_core.retry.if_exception_type(
+        google.api_core.exceptions.DeadlineExceeded,
+        google.api_core.exceptions.InternalServerError,
+        google.api_core.exceptions.ServiceUnavailable,
+        google.api_core.exceptions.TooManyRequests),
+    initial=1,
+    maximum=16,
+    multiplier=2,
+    deadline=120)
+_CREATE_RETRY = _RETRY.with_predicate(
+    google.api_core.retry.if_exception_type(
+        google.api_core.exceptions.ServiceUnavailable,
+        google.api_core.exceptions.TooManyRequests))
+
+# How many times the discovery clients retry a request that failed with a 5xx
+# or 429 response. They back off exponentially between attempts.
+_NUM_RETRIES = 5
+
+# How many times to try updating the IAM policy when it's changed concurrently.
+_SET_IAM_POLICY_ATTEMPTS = 3
+
+# The query used to materialize the web vitals summary table. The template is
+# read and parsed once, and only the project and GA property vary between
+# deployments.
+with open(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql',
+                 'materialize_web_vitals_summary.sql.tmpl')) as _sql_file:
+  _MATERIALIZE_SQL_TEMPLATE = string.Template(_sql_file.read())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_adc() -> Tuple[Credentials, Optional[str]]:
+  """Returns the application default credentials and project ID.
+
+  The lookup is only done once per process; later calls return the same
+  credentials object so any token it holds is reused. The credentials are
+  scoped up front so they can be refreshed directly, and so the clients use
+  them as they are rather than making scoped copies of their own.
+  """
+  return google.auth.default(
+      scopes=['https://www.googleapis.com/auth/cloud-platform'])
+
+
+@functools.lru_cache(maxsize=None)
+def _service(name: str, version: str,
+             credentials: Credentials) -> discovery.Resource:
+  """Returns a discovery service, building it only once per process.
+
+  The services are built from the discovery documents bundled with the client
+  library, so building one doesn't fetch anything over the network.
+
+  Args:
+    name: the name of the API, e.g. iam.
+    version: the version of the API, e.g. v1.
+    credentials: the Google credentials to use to authenticate.
+
+  Returns:
+    The service object for the API.
+  """
+  return discovery.build(name,
+                         version,
+                         credentials=credentials,
+                         cache_discovery=True,
+                         static_discovery=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_project_number(credentials: Credentials, project_id: str) -> str:
+  """Returns the number of the given project, looked up once per process.
+
+  Args:
+    credentials: the Google credentials to use to authenticate.
+    project_id: the ID of the project to look up.
+
+  Returns:
+    The project number in str format.
+  """
+  crm = _service('cloudresourcemanager', 'v3', credentials)
+  project = crm.projects().get(name='projects/' + project_id).execute(
+      num_retries=_NUM_RETRIES)
+  # the name of the project resource is in the form projects/<number>
+  return project['name'].split('/')[-1]
+
+
+@functools.lru_cache(maxsize=None)
+def _transfer_client(
+    credentials: Credentials
+) -> bigquery_datatransfer.DataTransferServiceClient:
+  """Returns a data transfer client whose gRPC channel is shared per process."""
+  return bigquery_datatransfer.DataTransferServiceClient(
+      credentials=credentials)
+
+
+def _run_in_background(fn, *args) -> concurrent.futures.Future:
+  """Calls a function in a daemon thread, returning a future for its result.
+
+  Unlike an executor's worker threads, the thread isn't joined when the
+  interpreter exits, so leaving early, e.g. on Ctrl-C at a prompt, doesn't wait
+  for the call to finish.
+
+  Args:
+    fn: the function to call.
+    *args: the arguments to call it with.
+
+  Returns:
+    A future holding the function's result, or the exception it raised.
+  """
+  future = concurrent.futures.Future()
+
+  def run():
+    try:
+      future.set_result(fn(*args))
+    except BaseException as ex:  # pylint: disable=broad-except
+      future.set_exception(ex)
+
+  threading.Thread(target=run, daemon=True).start()
+  return future
 
 
 def enable_services(credentials: Credentials, project_id: str):
@@ -44,18 +248,16 @@ def enable_services(credentials: Credentials, project_id: str):
     credentials: the Google credentials to use to authenticate.
     project_id: the project the services will be enabled for.
   """
-  print('Enabling GCP services')
-  crm = discovery.build('cloudresourcemanager', 'v3')
-  project = crm.projects().get(name='projects/' + project_id).execute()
+  project_number = _get_project_number(credentials, project_id)
   client = service_usage_v1.ServiceUsageClient(credentials=credentials)
   request = service_usage_v1.BatchEnableServicesRequest()
-  request.parent = project['name']
+  request.parent = 'projects/' + project_number
   request.service_ids = [
       'bigquery.googleapis.com',
       'bigquerydatatransfer.googleapis.com',
       'iam.googleapis.com',
   ]
-  operation = client.batch_enable_services(request=request)
+  operation = client.batch_enable_services(request=request, retry=_RETRY)
   try:
     operation.result()
   except google.api_core.GoogleAPICallError as ex:
@@ -63,53 +265,138 @@ def enable_services(credentials: Credentials, project_id: str):
                      ' logs and resolve the issues found there.') from ex
 
 
-def get_gcp_regions(credentials: Credentials, project_id: str) -> List[str]:
-  """Fetches the list of available GCP regions and returns a list of str.
+def _fetch_gcp_regions_live(credentials: Credentials,
+                            project_id: str) -> Iterator[str]:
+  """Fetches the available GCP regions, yielding their names as they arrive.
+
+  Only the region names are requested from the API.
 
   Args:
     credentials: the Google credentials to use to authenticate.
     project_id: The project to use when making the query.
 
-  Returns:
-    A list of region names in str format.
+  Yields:
+    The name of each region in str format.
   """
-  regions = []
-  service = discovery.build('compute', 'v1', credentials=credentials)
-  request = service.regions().list(project=project_id)
+  list_args = {
+      'project': project_id,
+      'maxResults': 500,
+      'fields': 'items(name),nextPageToken',
+  }
+  service = _service('compute', 'v1', credentials)
+  request = service.regions().list(**list_args)
   while request is not None:
-    response = request.execute()
-    for region in response['items']:
+    response = request.execute(num_retries=_NUM_RETRIES)
+    for region in response.get('items', []):
       if 'name' in region and region['name']:
-        regions.append(region['name'])
+        yield region['name']
 
-    if 'nextPageToken' in response:
-      request = service.regions().list(pageToken=response['nextPageToken'])
-    else:
-      request = None
+    request = service.regions().list_next(previous_request=request,
+                                          previous_response=response)
+
+
+def get_gcp_regions(credentials: Credentials,
+                    project_id: str,
+                    refresh: bool = False) -> List[str]:
+  """Returns the names of the available GCP regions.
+
+  The set of GCP regions rarely changes, so the built-in list is returned
+  unless a refresh is asked for. Refreshed lists are cached on disk per project
+  for a week. Failing to read or write the cache isn't an error; the regions are
+  fetched from the API instead.
+
+  Args:
+    credentials: the Google credentials to use to authenticate.
+    project_id: The project to use when making the query.
+    refresh: if True, the regions are read from the Compute API (or the cache
+      of a recent call to it) instead of the built-in list.
+
+  Returns:
+    A list of region names in str format.
+  """
+  if not refresh:
+    return list(GCP_REGIONS)
+
+  try:
+    with open(_REGION_CACHE_PATH) as cache_file:
+      cache = json.load(cache_file)
+  except (OSError, ValueError):
+    cache = {}
+  if not isinstance(cache, dict):
+    cache = {}
+
+  # an entry that doesn't have the expected shape, e.g. from a hand-edited
+  # cache, is treated as missing and overwritten.
+  entry = cache.get(project_id)
+  if (isinstance(entry, dict) and
+      isinstance(entry.get('fetched_at'), (int, float)) and
+      isinstance(entry.get('regions'), list) and
+      all(isinstance(region, str) for region in entry['regions']) and
+      time.time() - entry['fetched_at'] < _REGION_CACHE_TTL_SECONDS):
+    return entry['regions']
+
+  regions = list(_fetch_gcp_regions_live(credentials, project_id))
+  cache[project_id] = {'fetched_at': time.time(), 'regions': regions}
+  tmp_name = None
+  try:
+    cache_dir = os.path.dirname(_REGION_CACHE_PATH)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so a concurrent reader never sees a
+    # partially written cache.
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as tmp:
+      tmp_name = tmp.name
+      json.dump(cache, tmp)
+    os.replace(tmp_name, _REGION_CACHE_PATH)
+    tmp_name = None
+  except OSError:
+    pass
+  finally:
+    # the temporary file is only left behind if it wasn't moved into place.
+    if tmp_name:
+      try:
+        os.unlink(tmp_name)
+      except OSError:
+        pass
 
   return regions
 
 
-def delete_scheduled_query(display_name: str, project_id: str, region: str):
+def delete_scheduled_query(
+    transfer_client: bigquery_datatransfer.DataTransferServiceClient,
+    display_name: str, project_id: str, region: str):
   """Deletes the BigQuery scheduled queries with the given display name.
 
   Please note that the display name of a BigQuery scheduled query is not
-  unique. This means that multiple queries can be deleted.
+  unique. This means that multiple queries can be deleted. When there is more
+  than one, the deletions are made concurrently.
 
   Args:
+    transfer_client: the data transfer client to make the requests with.
     display_name: the name of the config to delete.
     project_id: the project to delete the query from.
     region: the region the query is stored in.
   """
-  transfer_client = bigquery_datatransfer.DataTransferServiceClient()
   parent = transfer_client.common_location_path(project=project_id,
                                                 location=region)
   transfer_config_req = bigquery_datatransfer.ListTransferConfigsRequest(
-      parent=parent, data_source_ids=['scheduled_query'])
-  configs = transfer_client.list_transfer_configs(request=transfer_config_req)
-  for config in configs:
-    if config.display_name == display_name:
-      transfer_client.delete_transfer_config(name=config.name)
+      parent=parent, data_source_ids=['scheduled_query'], page_size=1000)
+  configs = transfer_client.list_transfer_configs(request=transfer_config_req,
+                                                 retry=_RETRY)
+  to_delete = [c.name for c in configs if c.display_name == display_name]
+  if not to_delete:
+    return
+
+  def delete_config(name: str) -> None:
+    try:
+      transfer_client.delete_transfer_config(name=name, retry=_RETRY)
+    except google.api_core.exceptions.NotFound:
+      # a retried delete can find the config already removed by the attempt
+      # that timed out, or it was deleted since the configs were listed.
+      pass
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    # consuming the results re-raises any error from the deletes.
+    list(executor.map(delete_config, to_delete))
 
 
 def deploy_scheduled_materialize_query(project_id: str,
@@ -130,130 +417,15 @@ def deploy_scheduled_materialize_query(project_id: str,
   print('Deploying scheduled materialize query')
   display_name = 'Update Web Vitals Summary'
 
-  materialize_query = f"""
--- Copyright 2021 Google LLC
--- Licensed under the Apache License, Version 2.0 (the "License");
--- you may not use this file except in compliance with the License.
--- You may obtain a copy of the License at
-
---     https://www.apache.org/licenses/LICENSE-2.0
-
--- Unless required by applicable law or agreed to in writing, software
--- distributed under the License is distributed on an "AS IS" BASIS,
--- WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
--- See the License for the specific language governing permissions and
--- limitations under the License.
-
--- Materialize Web Vitals metrics from GA4 event export data
-
-CREATE OR REPLACE TABLE `{project_id}.analytics_{ga_property}.web_vitals_summary`
-  PARTITION BY DATE(event_timestamp)
-  CLUSTER BY metric_name
-AS
-SELECT
-  ga_session_id,
-  IF(
-    EXISTS(
-      SELECT 1
-      FROM UNNEST(events) AS e
-      WHERE e.event_name = 'first_visit'
-    ),
-    'New user',
-    'Returning user') AS user_type,
-  IF(
-    (SELECT MAX(session_engaged) FROM UNNEST(events)) > 0, 'Engaged', 'Not engaged')
-    AS session_engagement,
-  evt.* EXCEPT (session_engaged, event_name),
-  event_name AS metric_name,
-  FORMAT_TIMESTAMP('%Y%m%d', event_timestamp) AS event_date
-FROM
-  (
-    SELECT
-      ga_session_id,
-      ARRAY_AGG(custom_event) AS events
-    FROM
-      (
-        SELECT
-          ga_session_id,
-          STRUCT(
-            country,
-            device_category,
-            device_os,
-            traffic_medium,
-            traffic_name,
-            traffic_source,
-            page_path,
-            debug_target,
-            event_timestamp,
-            event_name,
-            metric_id,
-            IF(event_name = 'LCP', metric_value / 1000, metric_value)
-              AS metric_value,
-            user_pseudo_id,
-            session_engaged,
-            session_revenue) AS custom_event
-        FROM
-          (
-            SELECT
-              (SELECT value.int_value FROM UNNEST(event_params) WHERE key = 'ga_session_id')
-                AS ga_session_id,
-              (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'metric_id')
-                AS metric_id,
-              ANY_VALUE(device.category) AS device_category,
-              ANY_VALUE(device.operating_system) AS device_os,
-              ANY_VALUE(traffic_source.medium) AS traffic_medium,
-              ANY_VALUE(traffic_source.name) AS traffic_name,
-              ANY_VALUE(traffic_source.source) AS traffic_source,
-              ANY_VALUE(
-                REGEXP_SUBSTR(
-                  (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'page_location'),
-                  r'^[^?]+')) AS page_path,
-              ANY_VALUE(
-                (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'debug_target'))
-                AS debug_target,
-              ANY_VALUE(user_pseudo_id) AS user_pseudo_id,
-              ANY_VALUE(geo.country) AS country,
-              ANY_VALUE(event_name) AS event_name,
-              SUM(ecommerce.purchase_revenue) AS session_revenue,
-              MAX(
-                (
-                  SELECT
-                    COALESCE(
-                      value.double_value,
-                      value.int_value,
-                      CAST(value.string_value AS NUMERIC))
-                  FROM UNNEST(event_params)
-                  WHERE key = 'session_engaged'
-                )) AS session_engaged,
-              TIMESTAMP_MICROS(MAX(event_timestamp)) AS event_timestamp,
-              MAX(
-                (
-                  SELECT COALESCE(value.double_value, value.int_value)
-                  FROM UNNEST(event_params)
-                  WHERE key = 'metric_value'
-                )) AS metric_value,
-            FROM
-              `{project_id}.analytics_{ga_property}.events_*`
-            WHERE
-              event_name IN ('LCP', 'FID', 'CLS', 'INP', 'TTFB', 'first_visit', 'purchase')
-            GROUP BY
-              1, 2
-          )
-      )
-    WHERE
-      ga_session_id IS NOT NULL
-    GROUP BY ga_session_id
-  )
-CROSS JOIN UNNEST(events) AS evt
-WHERE evt.event_name NOT IN ('first_visit', 'purchase');
-  """
+  materialize_query = _MATERIALIZE_SQL_TEMPLATE.substitute(
+      project_id=project_id, ga_property=ga_property)
 
-  delete_scheduled_query(display_name=display_name,
+  transfer_client = _transfer_client(credentials)
+  delete_scheduled_query(transfer_client=transfer_client,
+                         display_name=display_name,
                          project_id=project_id,
                          region=region)
 
-  transfer_client = bigquery_datatransfer.DataTransferServiceClient(
-      credentials=credentials)
   parent = transfer_client.common_location_path(project=project_id,
                                                 location=region)
   transfer_config = bigquery_datatransfer.TransferConfig(
@@ -269,67 +441,134 @@ WHERE evt.event_name NOT IN ('first_visit', 'purchase');
       bigquery_datatransfer.CreateTransferConfigRequest(
           parent=parent,
           transfer_config=transfer_config,
-          service_account_name=service_account))
-  # wait 30 seconds for the query to complete. Otherwise anything depending on
-  # the table being created will fail.
-  time.sleep(30)
+          service_account_name=service_account),
+      retry=_CREATE_RETRY)
+  # wait for the query to complete. Otherwise anything depending on the table
+  # being created will fail.
+  wait_for_transfer_run(transfer_client, transfer_config.name)
+
+
+def wait_for_transfer_run(
+    transfer_client: bigquery_datatransfer.DataTransferServiceClient,
+    transfer_config_name: str) -> None:
+  """Waits for the run scheduled when a transfer config was created to finish.
+
+  Creating the config schedules its first run straight away, so that run is
+  waited on rather than starting another one alongside it. The run is polled
+  with exponential backoff, and the wait gives up after five minutes so a slow
+  query doesn't block the deployment indefinitely.
+
+  Args:
+    transfer_client: the data transfer client to make the requests with.
+    transfer_config_name: the resource name of the config that was created.
+
+  Raises:
+    SystemExit: Raised when the run fails or is cancelled.
+  """
+  deadline = time.monotonic() + _TRANSFER_RUN_TIMEOUT_SECONDS
+  delay = _TRANSFER_RUN_INITIAL_POLL_SECONDS
+  run = None
+  while True:
+    if run is None:
+      # the scheduled run can take a moment to be listed after the config is
+      # created.
+      runs = transfer_client.list_transfer_runs(parent=transfer_config_name,
+                                                retry=_RETRY)
+      run = next(iter(runs), None)
+    else:
+      run = transfer_client.get_transfer_run(name=run.name, retry=_RETRY)
+    if run is not None and run.state in _FINISHED_TRANSFER_STATES:
+      break
+    if time.monotonic() >= deadline:
+      print('The scheduled query is still running. The web vitals summary '
+            'table will be available once it completes.')
+      return
+    time.sleep(delay)
+    delay = min(delay * 2, _TRANSFER_RUN_MAX_POLL_SECONDS)
+
+  if run.state != bigquery_datatransfer.TransferState.SUCCEEDED:
+    raise SystemExit('The scheduled query did not complete successfully: '
+                     f'{run.error_status.message}. Please check the logs and '
+                     'resolve the issues found there.')
 
 
 def get_default_service_account_email(project_id: str,
                                       credentials: Credentials) -> str:
   """Gets the email address for the default iam service account.
 
+  The default compute service account's email is derived from the project
+  number, so it is fetched directly.
+
   Args:
     project_id: The GCP project to get the default account for.
     credentials: The credentials to use to authenticate.
 
   Returns:
-    The email address of the default compute iam service account.
+    The email address of the default compute iam service account, or an empty
+    string if the project doesn't have one.
   """
-  service = discovery.build('iam', 'v1', credentials=credentials)
-  service_accounts = service.projects().serviceAccounts().list(
-      name=f'projects/{project_id}').execute()
-  for account in service_accounts['accounts']:
-    display_name = account['displayName'].lower()
-    if display_name.find('default') != -1:
-      return account['email']
-
+  service = _service('iam', 'v1', credentials)
+  project_number = _get_project_number(credentials, project_id)
+  email = f'{project_number}-compute@developer.gserviceaccount.com'
+  try:
+    account = service.projects().serviceAccounts().get(
+        name=f'projects/{project_id}/serviceAccounts/{email}').execute(
+            num_retries=_NUM_RETRIES)
+    return account['email']
+  except errors.HttpError as ex:
+    if ex.resp.status != 404:
+      raise
+
+  # without the default compute account there is no reliable way to pick one,
+  # so the user is asked for it instead.
   return ''
 
 
-def add_roles_to_service_account(service_account: str, project_id: str,
-                                 credentials: Credentials) -> None:
-  """Creates a new role with the permissions required to deploy the solution
-  and it to the passed service account.
+def _get_iam_policy(crm: discovery.Resource, resource: str) -> Dict[str, Any]:
+  """Fetches the IAM policy of a resource using Cloud Resource Manager v3.
+
+  Version 3 is requested so conditional role bindings are returned intact and
+  aren't lost when the policy is written back.
 
-  The service account needs to have the correct permissions, and this is the
-  most straightforward way of ensuring that. The permissions in the new role are
-  - bigquery.tables.get
-  - bigquery.tables.get
-  - bigquery.tables.getData
-  - bigquery.tables.list
-  - bigquery.tables.create
-  - bigquery.tables.update
-  - bigquery.tables.updateData
-  - bigquery.jobs.list
-  - bigquery.jobs.create
-  - bigquery.transfers.update
   Args:
-    service_account: The service account to add the role to.
-    project_id: The project the new role will be created in.
-    credentials: The credentials to authenticate the new role request with.
+    crm: the cloudresourcemanager v3 service to make the request with.
+    resource: the name of the resource, e.g. projects/my-project.
+
+  Returns:
+    The IAM policy, including its etag.
   """
-  print('Adding roles to service account')
-  service = discovery.build('iam', 'v1', credentials=credentials)
-  role_resp = service.projects().roles().list(
-      parent=f'projects/{project_id}').execute()
-  current_roles = role_resp.get('roles', [])
+  return crm.projects().getIamPolicy(resource=resource,
+                                     body={
+                                         'options': {
+                                             'requestedPolicyVersion': 3
+                                         }
+                                     }).execute(num_retries=_NUM_RETRIES)
+
+
+def _get_or_create_deployer_role(project_id: str,
+                                 credentials: Credentials) -> Dict[str, Any]:
+  """Gets the custom role used to deploy the solution, creating it if needed.
+
+  Args:
+    project_id: The project the role belongs to.
+    credentials: The credentials to authenticate the role requests with.
+
+  Returns:
+    The role resource.
+
+  Raises:
+    SystemExit: Raised when the role could not be created.
+  """
+  service = _service('iam', 'v1', credentials)
   role = None
   # if the role already exists, it's an error to try and create it again
-  for r in current_roles:
-    if r['name'].endswith('cwv_in_ga4_deployer'):
-      role = r
-      break
+  try:
+    role = service.projects().roles().get(
+        name=f'projects/{project_id}/roles/cwv_in_ga4_deployer').execute(
+            num_retries=_NUM_RETRIES)
+  except errors.HttpError as ex:
+    if ex.resp.status != 404:
+      raise
   if not role:
     role = service.projects().roles().create(
         parent=f'projects/{project_id}',
@@ -353,22 +592,125 @@ def add_roles_to_service_account(service_account: str, project_id: str,
                      ' the BigQuery scheduled queries. Please check the cloud '
                      'logs, correct the issue, and try again.')
 
-  service = discovery.build('cloudresourcemanager',
-                            'v1',
-                            credentials=credentials)
-  policy = service.projects().getIamPolicy(resource=project_id,
-                                           body={
-                                               'options': {
-                                                   'requestedPolicyVersion': 1
-                                               }
-                                           }).execute()
-  policy['bindings'].append({
-      'role': role['name'],
-      'members': [f'serviceAccount:{service_account}']
-  })
-  service.projects().setIamPolicy(resource=project_id, body={
-      "policy": policy
-  }).execute()
+  return role
+
+
+def add_roles_to_service_account(service_account: str, project_id: str,
+                                 credentials: Credentials) -> None:
+  """Creates a new role with the permissions required to deploy the solution
+  and it to the passed service account.
+
+  The service account needs to have the correct permissions, and this is the
+  most straightforward way of ensuring that. The permissions in the new role are
+  - bigquery.tables.get
+  - bigquery.tables.get
+  - bigquery.tables.getData
+  - bigquery.tables.list
+  - bigquery.tables.create
+  - bigquery.tables.update
+  - bigquery.tables.updateData
+  - bigquery.jobs.list
+  - bigquery.jobs.create
+  - bigquery.transfers.update
+  Args:
+    service_account: The service account to add the role to.
+    project_id: The project the new role will be created in.
+    credentials: The credentials to authenticate the new role request with.
+  """
+  print('Adding roles to service account')
+  crm = _service('cloudresourcemanager', 'v3', credentials)
+  resource = f'projects/{project_id}'
+  # the policy doesn't depend on the role, so it's fetched while the role is
+  # looked up or created.
+  with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+    policy_future = executor.submit(_get_iam_policy, crm, resource)
+    role = _get_or_create_deployer_role(project_id, credentials)
+    policy = policy_future.result()
+
+  member = f'serviceAccount:{service_account}'
+  for attempt in range(_SET_IAM_POLICY_ATTEMPTS):
+    bindings = policy.setdefault('bindings', [])
+    # re-deploying shouldn't grow the policy, so the member is added to the
+    # role's existing binding when there is one. Conditional bindings are left
+    # alone as they don't always grant the role.
+    binding = next((b for b in bindings
+                    if b['role'] == role['name'] and 'condition' not in b),
+                   None)
+    if binding is None:
+      bindings.append({'role': role['name'], 'members': [member]})
+    elif member in binding['members']:
+      return
+    else:
+      binding['members'].append(member)
+
+    try:
+      # the etag makes the update fail if the policy was changed after it was
+      # read, rather than silently overwriting the other change.
+      crm.projects().setIamPolicy(resource=resource,
+                                  body={
+                                      'policy': {
+                                          'etag': policy['etag'],
+                                          'bindings': policy['bindings'],
+                                          'version': policy.get('version', 1),
+                                      }
+                                  }).execute(num_retries=_NUM_RETRIES)
+      return
+    except errors.HttpError as ex:
+      if (ex.resp.status not in (409, 412) or
+          attempt == _SET_IAM_POLICY_ATTEMPTS - 1):
+        raise
+    time.sleep(random.uniform(0, 2**attempt))
+    policy = _get_iam_policy(crm, resource)
+
+
+def load_config(path: pathlib.Path, options: Dict[str, Any]) -> Dict[str, Any]:
+  """Loads option values from a TOML config file.
+
+  Keys may be written either as the option name (ga-property) or as its
+  attribute name (ga_property). Flags must be given as booleans, and the other
+  options as strings or integers.
+
+  Args:
+    path: the path of the TOML file to load.
+    options: the parsed options the file may set, mapping their attribute names
+      to their values.
+
+  Returns:
+    A dict mapping option attribute names to their values.
+
+  Raises:
+    SystemExit: Raised when the file can't be read, has unknown keys or has a
+      value of the wrong type.
+  """
+  try:
+    import tomllib  # pylint: disable=g-import-not-at-top
+  except ImportError as ex:
+    raise SystemExit('Config files require Python 3.11 or later.') from ex
+
+  try:
+    config = tomllib.loads(path.read_text())
+  except (OSError, tomllib.TOMLDecodeError) as ex:
+    raise SystemExit(f'Unable to read the config file {path}: {ex}') from ex
+
+  config = {key.replace('-', '_'): value for key, value in config.items()}
+  # a config file can't point at another config file.
+  unknown = set(config) - (set(options) - {'config'})
+  if unknown:
+    raise SystemExit(f'Unknown options in the config file {path}: ' +
+                     ', '.join(sorted(unknown)))
+
+  # argparse only converts string defaults for options with a type, so values
+  # are used as they are; a string "false" would turn a flag on.
+  for key, value in config.items():
+    if isinstance(options[key], bool):
+      valid = isinstance(value, bool)
+    else:
+      valid = isinstance(value, (str, int)) and not isinstance(value, bool)
+    if not valid:
+      raise SystemExit(f'Invalid value for {key} in the config file {path}: '
+                       f'{value!r}')
+
+  return config
 
 
 def main():
@@ -398,50 +740,142 @@ def main():
                                 'account requires roles/eventarc.eventReceiver.'
                                 ' If not provided, the default compute service '
                                 'account is used.'))
+  arg_parser.add_argument('--refresh-regions',
+                          action='store_true',
+                          help=('List the regions reported by the Compute API '
+                                'instead of the built-in list.'))
+  arg_parser.add_argument('--config',
+                          type=pathlib.Path,
+                          help=('A TOML file providing values for any of the '
+                                'options above, e.g. region = "us-central1". '
+                                'Options given on the command line take '
+                                'precedence.'))
 
   args = arg_parser.parse_args()
+  if args.config:
+    # the file's values become the defaults, so re-parsing lets anything on
+    # the command line override them.
+    arg_parser.set_defaults(**load_config(args.config, vars(args)))
+    args = arg_parser.parse_args()
+
+  # without a terminal there is nobody to answer the prompts below, so
+  # everything they would ask for must be on the command line.
+  if not sys.stdin.isatty():
+    missing = [
+        option for option, value in (
+            ('--region', args.region),
+            ('--ga-property', args.ga_property),
+            ('--iam-service-account', args.iam_service_account),
+        ) if not value
+    ]
+    if missing:
+      arg_parser.error('the following arguments are required when not '
+                       'running interactively: ' + ', '.join(missing))
+
+  # the GA property is checked before anything is sent to the APIs, so a bad
+  # ID fails straight away. A config file may give it as a string.
+  if not args.ga_property:
+    args.ga_property = (input(
+        'Please enter the GA property ID you are collecting CWV data with: ').
+                        strip())
+  if not str(args.ga_property).isdigit():
+    raise SystemExit('Only GA4 properties are supported at this time.')
 
-  credentials, project_id = google.auth.default()
+  credentials, project_id = _get_adc()
   if not project_id:
     project_id = os.environ['GOOGLE_CLOUD_PROJECT']
-
-  enable_services(credentials, project_id)
+  # refreshing Compute Engine credentials replaces the 'default' placeholder
+  # with the email the metadata server reports, so the email is read first.
+  adc_service_account = getattr(credentials, 'service_account_email', None)
+  # fetch the access token once up front. Every client below shares these
+  # credentials, so none of them need to refresh it, and the background
+  # threads don't race each other to do so.
+  credentials.refresh(google.auth.transport.requests.Request())
+
+  # enabling the services is a long-running operation that doesn't depend on
+  # any of the answers below, so it runs in the background while the user is
+  # prompted. A refreshed region list is fetched the same way so it is ready if
+  # the user asks for it. Anything printed from the background would interrupt
+  # the prompts, so the progress message is printed here.
+  print('Enabling GCP services')
+  enable_future = _run_in_background(enable_services, credentials, project_id)
+  regions_future = None
+  if not args.region and args.refresh_regions:
+    regions_future = _run_in_background(get_gcp_regions, credentials,
+                                        project_id, True)
+
+  def known_regions() -> List[str]:
+    # --refresh-regions asks the Compute API, which the deployment doesn't
+    # enable, so the built-in list is used when the API can't be reached.
+    try:
+      if regions_future is not None:
+        return regions_future.result()
+      return get_gcp_regions(credentials, project_id, args.refresh_regions)
+    except errors.HttpError as ex:
+      print(f'Unable to list the regions from the Compute API ({ex}). The '
+            'built-in list is used instead.')
+      return list(GCP_REGIONS)
 
   if not args.region:
     args.region = input(
-        'Which region should be deployed to (type list for a list)? ').strip()
-    while args.region == 'list':
-      region_list = get_gcp_regions(credentials, project_id)
-      print('\n'.join(region_list))
+        'Which region should be deployed to (type list for a list, or '
+        'list <prefix> to filter it)? ').strip()
+    while args.region.split(' ', 1)[0] == 'list':
+      prefix = args.region[len('list'):].strip()
+      for region in known_regions():
+        if region.startswith(prefix):
+          sys.stdout.write(region + '\n')
       args.region = (input(
           'Which region is the GA export in (list for a list of regions)? ').
                      strip())
 
-  if not args.ga_property:
-    args.ga_property = (input(
-        'Please enter the GA property ID you are collecting CWV data with: ').
-                        strip())
-    if not args.ga_property.isdigit():
-      raise SystemExit('Only GA4 properties are supported at this time.')
+  # an unknown region would only fail once the scheduled query is created, so
+  # it's checked here. The built-in list can miss regions added since it was
+  # written, so an unknown region is confirmed rather than rejected outright.
+  # The list fetched for the prompt is reused rather than fetched again.
+  if (args.region.lower() not in _VALID_REGIONS and
+      (not args.refresh_regions or args.region not in known_regions())):
+    suggestions = difflib.get_close_matches(args.region.lower(),
+                                            _VALID_REGIONS)
+    message = f'{args.region} is not a known GCP region.'
+    if suggestions:
+      message += ' Did you mean ' + ' or '.join(suggestions) + '?'
+    if not args.refresh_regions:
+      message += (' If it is a new region, --refresh-regions checks it against'
+                  ' the Compute API.')
+    if sys.stdin.isatty():
+      answer = input(message + f' Deploy to {args.region} anyway? [y/N] ')
+      if answer.strip().lower() not in ('y', 'yes'):
+        raise SystemExit('Deployment cancelled.')
+    else:
+      print(message + f' Deploying to {args.region} anyway.')
+
+  # the IAM API is needed from here on, so the services must be enabled. Any
+  # SystemExit raised while enabling them is re-raised here.
+  enable_future.result()
 
   # the options are a service account email is provided with the default
   # credentials, the word default is provided in place of an email address, or
   # the service_account_email field isn't present at all on the credentials.
   if not args.iam_service_account:
     input_msg = 'Please enter the email of the service account to use: '
-    if hasattr(credentials, 'service_account_email'):
-      if credentials.service_account_email == 'default':
+    if adc_service_account is not None:
+      if adc_service_account == 'default':
         args.iam_service_account = get_default_service_account_email(
             project_id, credentials)
       else:
-        args.iam_service_account = credentials.service_account_email
+        args.iam_service_account = adc_service_account
 
+    if args.iam_service_account:
       input_msg = (
           'Please note: using the default service account, '
           f'{args.iam_service_account}, will result in a new role being '
           'created to allow for the creation and execution of BigQuery '
           'scheduled queries.\n' + input_msg)
-
+    elif adc_service_account == 'default':
+      input_msg = ('Please note: the project does not have a default compute '
+                   'service account. You must provide one here.\n' +
+                   input_msg)
     else:
       input_msg = ('Please note: your default credentials do not provide a '
                    'service account. You must provide one here.\n' + input_msg)